@@ -2,17 +2,182 @@
 # -*-coding: utf-8 -*-
 
 from __future__ import print_function
+import heapq
+import itertools
+import logging
+import os
 import pymysql
 import re
+import threading
+import time
 
 
 err = pymysql.err
 cursors = pymysql.cursors
 
+logger = logging.getLogger(__name__)
+
+_clock = getattr(time, 'monotonic', time.time)  # Python 2 has no monotonic clock
+
+# Server error codes of a statement stopped by KILL QUERY and by the MAX_EXECUTION_TIME optimizer hint
+ER_QUERY_INTERRUPTED = 1317
+ER_QUERY_TIMEOUT = 3024
+
+# Seconds allowed to each step (connect, send, receive) of the side connection issuing KILL QUERY
+KILL_TIMEOUT = 2
+
+
+class QueryTimeout(err.OperationalError):
+    """
+    Raised when a query runs past its timeout. The query has been stopped on the server and the connection can be
+    reused.
+
+    Except for select() and get(), the query is stopped by KILL QUERY sent from a new connection with the same host,
+    port and credentials, so the server must accept one more connection from that user. A user can always kill its
+    own queries. If the kill fails, a warning is logged on the "dictmysql" logger and the query runs to completion.
+    """
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer(object):
+    """
+    Single-flight layer for identical concurrent reads. Share one instance between the DictMySQL clients of a thread
+    pool: while a query is in flight, other callers asking for the same SQL and args wait for it and share its result
+    instead of sending their own. Nothing is kept once the query returns, so results are never stale.
+
+    Only clients with autocommit=True take part. Without autocommit, each client reads from its own transaction
+    snapshot and sees its own uncommitted writes, so sharing rows between them would break read-your-writes. Queries
+    are only shared between clients connected to the same server and database with the same user, charset and
+    use_unicode.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.saved = 0
+
+    @staticmethod
+    def _reraise(error):
+        """
+        Raise a copy of the leader's error, so that followers don't share and rewrite one traceback across threads
+        """
+        try:
+            fresh = type(error)(*error.args)
+        except Exception:
+            raise error
+        # same as "raise fresh from error", which Python 2 doesn't support
+        fresh.__cause__ = error
+        raise fresh
+
+    def do(self, key, fn):
+        """
+        :param key: hashable. Identity of the query.
+        :param fn: callable. Runs the query and returns its result, only called by the first caller of the key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.saved += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                self._reraise(call.error)
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            # also KeyboardInterrupt or gevent Timeout, so that followers don't take the missing result for no rows
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _Watchdog(object):
+    """
+    Runs callbacks at their deadlines from one long-lived daemon thread, so that a query timeout doesn't start a
+    thread per statement. Deadlines are kept in a heap, and cancelled ones are dropped when they reach the top.
+    A forked child doesn't inherit the thread, so the watchdog starts over in a process it wasn't created in.
+    """
+    def __init__(self):
+        self._fork_lock = threading.Lock()
+        self._counter = itertools.count()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._thread = None
+
+    def schedule(self, timeout, fn):
+        """
+        :param timeout: float. Seconds from now.
+        :param fn: callable. Called from the watchdog thread when the deadline passes, unless cancelled before.
+        :return: The entry to pass to cancel().
+        """
+        entry = [_clock() + timeout, next(self._counter), fn]
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='dictmysql-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._cond:
+            entry[2] = None
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - _clock()
+                if delay <= 0:
+                    entry = heapq.heappop(self._heap)
+                    fn, entry[2] = entry[2], None
+                    return fn
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            fn = self._next()
+            try:
+                fn()
+            except Exception:
+                logger.exception('Query watchdog callback failed')
+
+
+_watchdog = _Watchdog()
+
 
 class DictMySQL:
     def __init__(self, host, user, passwd, db=None, port=3306, charset='utf8', init_command='SET NAMES UTF8',
-                 cursorclass=cursors.Cursor, use_unicode=True, autocommit=False):
+                 cursorclass=cursors.Cursor, use_unicode=True, autocommit=False, coalescer=None, timeout=None):
         self.host = host
         self.port = int(port)
         self.user = user
@@ -29,6 +194,9 @@ class DictMySQL:
                                                       use_unicode=self.use_unicode, autocommit=self.autocommit_mode)
         self.cursor = self.cur = self.conn.cursor()
         self.debug = False
+        self.coalescer = coalescer
+        self.timeout = timeout
+        self._pending_kill = None
 
     def reconnect(self):
         self.connection = self.conn = pymysql.connect(host=self.host, port=self.port, user=self.user,
@@ -38,12 +206,96 @@ class DictMySQL:
         self.cursor = self.cur = self.conn.cursor()
         return True
 
-    def query(self, sql, args=None):
+    def query(self, sql, args=None, timeout=None):
         """
         :param sql: string. SQL query.
         :param args: tuple. Arguments of this query.
+        :param timeout: float. Seconds before the query is killed, defaults to the timeout of the instance.
         """
-        return self.cur.execute(sql, args)
+        return self._execute(sql, args, timeout=self._timeout(timeout))
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    def _kill_query(self, thread_id):
+        conn = pymysql.connect(host=self.host, port=self.port, user=self.user, passwd=self.passwd,
+                               charset=self.charset, use_unicode=self.use_unicode, connect_timeout=KILL_TIMEOUT,
+                               read_timeout=KILL_TIMEOUT, write_timeout=KILL_TIMEOUT)
+        try:
+            conn.cursor().execute('KILL QUERY %d;' % thread_id)
+        finally:
+            conn.close()
+
+    def _execute(self, sql, args=None, timeout=None, many=False):
+        """
+        Execute on the cursor. With a timeout, the shared watchdog thread starts a KILL QUERY from a side connection
+        when the deadline passes, and QueryTimeout is raised instead of the interrupted error. Scheduling a deadline
+        only costs a heap push, while a query that is killed also costs a thread and a new connection to the server.
+        """
+        execute = self.cur.executemany if many else self.cur.execute
+
+        if self._pending_kill is not None:
+            # a KILL QUERY still on its way for the previous statement must not hit this one
+            self._pending_kill.wait(3 * KILL_TIMEOUT)
+            self._pending_kill = None
+
+        if not timeout:
+            try:
+                return execute(sql, args)
+            except err.OperationalError as e:
+                if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+                    raise QueryTimeout(*e.args)
+                raise
+
+        lock = threading.Lock()
+        state = {'running': True, 'killing': None, 'killed': False}
+        thread_id = self.conn.thread_id()
+
+        def _send_kill():
+            try:
+                self._kill_query(thread_id)
+                state['killed'] = True
+            except err.MySQLError:
+                logger.warning('KILL QUERY %d failed after %s seconds, the query keeps running', thread_id,
+                               timeout, exc_info=True)
+            finally:
+                state['killing'].set()
+
+        def _kill():
+            # called from the watchdog thread, which hands the network I/O to a thread of its own
+            with lock:
+                if not state['running']:
+                    return
+                state['killing'] = threading.Event()
+            t = threading.Thread(target=_send_kill, name='dictmysql-kill')
+            t.daemon = True
+            t.start()
+
+        def _stop():
+            _watchdog.cancel(deadline)
+            with lock:
+                state['running'] = False
+            return state['killing']
+
+        deadline = _watchdog.schedule(timeout, _kill)
+        try:
+            result = execute(sql, args)
+        except err.OperationalError as e:
+            killing = self._pending_kill = _stop()
+            if killing is not None and e.args and e.args[0] == ER_QUERY_INTERRUPTED:
+                # only an interrupted query waits for the kill, to tell whether it was ours
+                killing.wait(3 * KILL_TIMEOUT)
+                if state['killed']:
+                    raise QueryTimeout(*e.args)
+            # the server may also stop the query itself, through a hint in the SQL or max_execution_time
+            if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+                raise QueryTimeout(*e.args)
+            raise
+        except BaseException:
+            self._pending_kill = _stop()
+            raise
+        self._pending_kill = _stop()
+        return result
 
     @staticmethod
     def _backtick_columns(cols):
@@ -296,6 +548,27 @@ class DictMySQL:
         except NameError:
             return isinstance(s, str)  # Python 3 string
 
+    @staticmethod
+    def _copy_result(result):
+        """
+        Give each caller of a coalesced query its own rows, so that DictCursor results can be modified safely
+        """
+        if isinstance(result, list):
+            return [dict(r) if isinstance(r, dict) else r for r in result]
+        return result
+
+    def _fetchall_coalesced(self, sql, args):
+        def _execute():
+            self._execute(sql, args)
+            return self.cur.fetchall()
+
+        key = (self.host, self.port, self.user, self.db, self.charset, self.use_unicode, self.cursorclass, sql, args)
+        try:
+            hash(key)
+        except TypeError:
+            return _execute()
+        return self._copy_result(self.coalescer.do(key, _execute))
+
     def _by_columns(self, columns):
         """
         Allow select.group and select.order accepting string and list
@@ -303,7 +576,7 @@ class DictMySQL:
         return columns if self.isstr(columns) else self._backtick_columns(columns)
 
     def select(self, table, columns=None, join=None, where=None, group=None, having=None, order=None, limit=None,
-               iterator=False, fetch=True):
+               iterator=False, fetch=True, timeout=None):
         """
         :type table: string
         :type columns: list
@@ -320,6 +593,15 @@ class DictMySQL:
         :param iterator: Whether to output the result in a generator. It always returns generator if the cursor is
                          SSCursor or SSDictCursor, no matter iterator is True or False.
         :type fetch: bool
+        :type timeout: float
+        :param timeout: Seconds the query may run, defaults to the timeout of the instance. It is enforced by the server
+                        through the MAX_EXECUTION_TIME optimizer hint, and QueryTimeout is raised when it is exceeded.
+                        The hint needs MySQL 5.7.8 or later and only applies to read-only SELECTs. MariaDB and older
+                        MySQL servers read it as a comment, so there the timeout does nothing and no error is raised.
+        :return: When a coalescer is set and autocommit is on, concurrent identical queries that fetch all rows share
+                 one execution. A caller that receives shared rows runs nothing on its own cursor, so rowcount(),
+                 fetchone() and cur.description are left as they were after its previous query. Use the returned
+                 rows instead of the cursor state.
         """
         if not columns:
             columns = ['*']
@@ -327,7 +609,11 @@ class DictMySQL:
 
         # TODO: support multiple table
 
-        _sql = ''.join(['SELECT ', self._backtick_columns(columns),
+        timeout = self._timeout(timeout)
+
+        _sql = ''.join(['SELECT ',
+                        '/*+ MAX_EXECUTION_TIME(%d) */ ' % max(int(timeout * 1000), 1) if timeout else '',
+                        self._backtick_columns(columns),
                         ' FROM ', self._tablename_parser(table)['formatted_tablename'],
                         self._join_parser(join),
                         where_q,
@@ -339,7 +625,11 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql, _args)
 
-        execute_result = self.cur.execute(_sql, _args)
+        if self.coalescer is not None and self.autocommit_mode and fetch and not iterator \
+                and self.cursorclass not in (pymysql.cursors.SSCursor, pymysql.cursors.SSDictCursor):
+            return self._fetchall_coalesced(_sql, _args)
+
+        execute_result = self._execute(_sql, _args)
 
         if not fetch:
             return execute_result
@@ -371,7 +661,7 @@ class DictMySQL:
             if self.debug:
                 break
 
-    def get(self, table, column, join=None, where=None, insert=False, ifnone=None):
+    def get(self, table, column, join=None, where=None, insert=False, ifnone=None, timeout=None):
         """
         A simplified method of select, for getting the first result in one column only. A common case of using this
         method is getting id.
@@ -384,8 +674,9 @@ class DictMySQL:
         :type ifnone: string
         :param ifnone: When ifnone is a non-empty string, raise an error if query returns empty result. insert parameter
                        would not work in this mode.
+        :type timeout: float
         """
-        select_result = self.select(table=table, columns=[column], join=join, where=where, limit=1)
+        select_result = self.select(table=table, columns=[column], join=join, where=where, limit=1, timeout=timeout)
 
         if self.debug:
             return select_result
@@ -401,17 +692,18 @@ class DictMySQL:
         if insert:
             if any([isinstance(d, dict) for d in where.values()]):
                 raise ValueError("The where parameter in get() doesn't support nested condition with insert==True.")
-            return self.insert(table=table, value=where)
+            return self.insert(table=table, value=where, timeout=timeout)
 
         return None
 
-    def insert(self, table, value, ignore=False, commit=True):
+    def insert(self, table, value, ignore=False, commit=True, timeout=None):
         """
         Insert a dict into db.
         :type table: string
         :type value: dict
         :type ignore: bool
         :type commit: bool
+        :type timeout: float
         :return: int. The row id of the insert.
         """
         value_q, _args = self._value_parser(value, columnname=False)
@@ -421,18 +713,19 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql, _args)
 
-        self.cur.execute(_sql, _args)
+        self._execute(_sql, _args, timeout=self._timeout(timeout))
         if commit:
             self.conn.commit()
         return self.cur.lastrowid
 
-    def upsert(self, table, value, update_columns=None, commit=True):
+    def upsert(self, table, value, update_columns=None, commit=True, timeout=None):
         """
         :type table: string
         :type value: dict
         :type update_columns: list
         :param update_columns: specify the columns which will be updated if record exists
         :type commit: bool
+        :type timeout: float
         """
         if not isinstance(value, dict):
             raise TypeError('Input value should be a dictionary')
@@ -450,12 +743,12 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql, _args)
 
-        self.cur.execute(_sql, _args)
+        self._execute(_sql, _args, timeout=self._timeout(timeout))
         if commit:
             self.conn.commit()
         return self.cur.lastrowid
 
-    def insertmany(self, table, columns, value, ignore=False, commit=True):
+    def insertmany(self, table, columns, value, ignore=False, commit=True, timeout=None):
         """
         Insert multiple records within one query.
         :type table: string
@@ -465,6 +758,7 @@ class DictMySQL:
         :param value: Example: [(value1_column1, value1_column2,), ]
         :type ignore: bool
         :type commit: bool
+        :type timeout: float
         :return: int. The row id of the LAST insert only.
         """
         if not isinstance(value, (list, tuple)):
@@ -486,18 +780,20 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql_full, _args_flattened)
 
-        self.cur.executemany(_sql, _args)
+        self._execute(_sql, _args, timeout=self._timeout(timeout), many=True)
         if commit:
             self.conn.commit()
         return self.cur.lastrowid
 
-    def update(self, table, value, where, join=None, commit=True):
+    def update(self, table, value, where, join=None, commit=True, timeout=None):
         """
         :type table: string
         :type value: dict
         :type where: dict
         :type join: dict
         :type commit: bool
+        :type timeout: float
+        :param timeout: Seconds before the query is killed by KILL QUERY, defaults to the timeout of the instance.
         """
 
         value_q, _value_args = self._value_parser(value, columnname=True)
@@ -512,16 +808,17 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql, _args)
 
-        result = self.cur.execute(_sql, _args)
+        result = self._execute(_sql, _args, timeout=self._timeout(timeout))
         if commit:
             self.commit()
         return result
 
-    def delete(self, table, where=None, commit=True):
+    def delete(self, table, where=None, commit=True, timeout=None):
         """
         :type table: string
         :type where: dict
         :type commit: bool
+        :type timeout: float
         """
         where_q, _args = self._where_parser(where)
 
@@ -534,7 +831,7 @@ class DictMySQL:
         if self.debug:
             return self.cur.mogrify(_sql, _args)
 
-        result = self.cur.execute(_sql, _args)
+        result = self._execute(_sql, _args, timeout=self._timeout(timeout))
         if commit:
             self.commit()
         return result
@@ -543,14 +840,14 @@ class DictMySQL:
         _sql = "SELECT `COLUMN_NAME` FROM `INFORMATION_SCHEMA`.`COLUMNS` WHERE `TABLE_SCHEMA`=%s AND `TABLE_NAME`=%s;"
         _args = (self.db, table)
 
-        self.cur.execute(_sql, _args)
+        self._execute(_sql, _args, timeout=self.timeout)
         return self.cur.fetchall()
 
     def table_name(self):
         _sql = "SELECT `table_name` FROM `INFORMATION_SCHEMA`.`TABLES` where `TABLE_SCHEMA`=%s;"
         _args = (self.db,)
 
-        self.cur.execute(_sql, _args)
+        self._execute(_sql, _args, timeout=self.timeout)
         return self.cur.fetchall()
 
     def now(self):
@@ -558,7 +855,7 @@ class DictMySQL:
         if self.debug:
             return query
 
-        self.cur.execute(query)
+        self._execute(query, timeout=self.timeout)
         return self.cur.fetchone()[0 if self.cursorclass is pymysql.cursors.Cursor else 'now'].strftime(
                 "%Y-%m-%d %H:%M:%S")
 
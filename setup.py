@@ -44,5 +44,5 @@ setup(name='dictmysql',
 
       url='https://ligyxy.github.io/DictMySQL/',
 
-      install_requires=["PyMySQL>=0.7"],
+      install_requires=["PyMySQL>=0.7.3"],
       )
@@ -1,8 +1,67 @@
 #!/usr/bin/python
 # -*-coding: utf-8 -*-
 
+import os
+import threading
+import time
 import unittest
-from dictmysql import DictMySQL
+import dictmysql
+from dictmysql import DictMySQL, Coalescer, QueryTimeout, cursors, err
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Condition not met within %s seconds' % timeout)
+        time.sleep(0.001)
+
+
+class StubCursor(object):
+    def __init__(self, rows=(), error=None, gate=None):
+        self.rows = rows
+        self.error = error
+        self.gate = gate
+        self.started = threading.Event()
+        self.executed = []
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def mogrify(self, sql, args=None):
+        return sql % tuple(args or ())
+
+
+class StubConnection(object):
+    def thread_id(self):
+        return 42
+
+
+def stub_client(cursor, cursorclass=cursors.Cursor, autocommit=True, coalescer=None, timeout=None):
+    """
+    A DictMySQL running on a stub cursor, without connecting to a server
+    """
+    db = DictMySQL.__new__(DictMySQL)
+    db.host, db.port, db.user, db.passwd, db.db = 'localhost', 3306, 'root', '', 'occupation'
+    db.charset, db.use_unicode = 'utf8', True
+    db.cursorclass = cursorclass
+    db.autocommit_mode = autocommit
+    db.connection = db.conn = StubConnection()
+    db.cursor = db.cur = cursor
+    db.debug = False
+    db.coalescer = coalescer
+    db.timeout = timeout
+    db._pending_kill = None
+    return db
 
 
 class TestSQLConversion(unittest.TestCase):
@@ -35,6 +94,307 @@ class TestSQLConversion(unittest.TestCase):
         self.assertEqual(self.connection.last_query,
                          " WHERE (`id` < 20)")
 
+    def testSelectTimeout(self):
+        self.assertEqual(self.connection.select(table='jobs', columns=['id'], timeout=0.5),
+                         "SELECT /*+ MAX_EXECUTION_TIME(500) */ `id` FROM `jobs`;")
+
+    def testDefaultTimeout(self):
+        self.connection.timeout = 2
+        self.assertEqual(self.connection.select(table='jobs', columns=['id']),
+                         "SELECT /*+ MAX_EXECUTION_TIME(2000) */ `id` FROM `jobs`;")
+        self.assertEqual(self.connection.select(table='jobs', columns=['id'], timeout=0),
+                         "SELECT `id` FROM `jobs`;")
+
+    def testGetTimeout(self):
+        self.assertEqual(self.connection.get(table='jobs', column='id', where={'id': 5}, timeout=0.5),
+                         "SELECT /*+ MAX_EXECUTION_TIME(500) */ `id` FROM `jobs` WHERE (`id` = 5) LIMIT 1;")
+
+
+class FailingCoalescer(Coalescer):
+    def do(self, key, fn):
+        raise AssertionError('Query should not be coalesced')
+
+
+class TestCoalescer(unittest.TestCase):
+    def testConcurrentCallsShareResult(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return [(1, 'Teacher')]
+
+        leader = threading.Thread(target=lambda: results.append(coalescer.do('key', query)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        followers = [threading.Thread(target=lambda: results.append(coalescer.do('key', query))) for _ in range(3)]
+        for t in followers:
+            t.start()
+        wait_until(lambda: coalescer.saved == 3)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(coalescer.saved, 3)
+        self.assertEqual(results, [[(1, 'Teacher')]] * 4)
+        self.assertEqual(coalescer.do('key', lambda: 'fresh'), 'fresh')
+
+    def _run_concurrent_selects(self, leader_cursor, followers=2):
+        """
+        Run a select on a client whose cursor blocks until released, and the same select on other clients while it
+        is in flight. Returns the coalescer, the follower cursors and the results or errors of all callers.
+        """
+        coalescer = Coalescer()
+        gate = leader_cursor.gate
+        follower_cursors = [StubCursor() for _ in range(followers)]
+        outcomes = []
+
+        def select(cursor):
+            db = stub_client(cursor, cursorclass=cursors.DictCursor, coalescer=coalescer)
+            try:
+                outcomes.append(db.select(table='jobs', where={'id': 5}))
+            except Exception as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=select, args=(leader_cursor,))]
+        threads[0].start()
+        self.assertTrue(leader_cursor.started.wait(5))
+        threads += [threading.Thread(target=select, args=(c,)) for c in follower_cursors]
+        for t in threads[1:]:
+            t.start()
+        wait_until(lambda: coalescer.saved == followers)
+        gate.set()
+        for t in threads:
+            t.join(5)
+        return coalescer, follower_cursors, outcomes
+
+    def testSelectSharesCopiedRows(self):
+        leader = StubCursor(rows=[{'id': 5, 'value': 'Teacher'}], gate=threading.Event())
+        coalescer, follower_cursors, outcomes = self._run_concurrent_selects(leader)
+
+        self.assertEqual(len(leader.executed), 1)
+        self.assertEqual([c.executed for c in follower_cursors], [[], []])
+        self.assertEqual(outcomes, [[{'id': 5, 'value': 'Teacher'}]] * 3)
+        # every caller gets its own dicts
+        self.assertEqual(len(set(id(o[0]) for o in outcomes)), 3)
+
+    def testLeaderErrorReachesFollowers(self):
+        error = err.OperationalError(2013, 'Lost connection to MySQL server during query')
+        leader = StubCursor(error=error, gate=threading.Event())
+        coalescer, follower_cursors, outcomes = self._run_concurrent_selects(leader)
+
+        self.assertEqual(len(outcomes), 3)
+        self.assertEqual(sum(1 for o in outcomes if o is error), 1)
+        for o in outcomes:
+            self.assertIsInstance(o, err.OperationalError)
+            self.assertEqual(o.args, error.args)
+            if o is not error:
+                self.assertIs(o.__cause__, error)
+
+    def testLeaderBaseExceptionReachesFollowers(self):
+        class Interrupted(BaseException):
+            pass
+
+        coalescer = Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def query():
+            started.set()
+            release.wait(5)
+            raise Interrupted('stop')
+
+        def call():
+            try:
+                outcomes.append(coalescer.do('key', query))
+            except Interrupted as e:
+                outcomes.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        self.assertTrue(started.wait(5))
+        follower = threading.Thread(target=call)
+        follower.start()
+        wait_until(lambda: coalescer.saved == 1)
+        release.set()
+        for t in (leader, follower):
+            t.join(5)
+
+        self.assertEqual(len(outcomes), 2)
+        for o in outcomes:
+            self.assertIsInstance(o, Interrupted)
+
+    def testBypass(self):
+        rows = [(5, 'Teacher')]
+        coalescer = FailingCoalescer()
+
+        db = stub_client(StubCursor(rows=rows), cursorclass=cursors.SSCursor, coalescer=coalescer)
+        self.assertIs(db.select(table='jobs'), db.cur)
+
+        db = stub_client(StubCursor(rows=rows), coalescer=coalescer)
+        db.select(table='jobs', iterator=True)
+        self.assertEqual(len(db.cur.executed), 1)
+
+        db = stub_client(StubCursor(rows=rows), autocommit=False, coalescer=coalescer)
+        self.assertEqual(db.select(table='jobs'), rows)
+
+    def testKeyIncludesConnectionSettings(self):
+        class RecordingCoalescer(Coalescer):
+            keys = []
+
+            def do(self, key, fn):
+                self.keys.append(key)
+                return fn()
+
+        coalescer = RecordingCoalescer()
+        clients = [stub_client(StubCursor(rows=[(5, 'Teacher')]), coalescer=coalescer) for _ in range(3)]
+        clients[1].use_unicode = False
+        clients[2].charset = 'latin1'
+        for db in clients:
+            db.select(table='jobs')
+        self.assertEqual(len(set(coalescer.keys)), 3)
+
+    def testUnhashableArgsFallBack(self):
+        db = stub_client(StubCursor(rows=[(5, 'Teacher')]), coalescer=FailingCoalescer())
+        self.assertEqual(db.select(table='jobs', where={'value': bytearray(b'Teacher')}), [(5, 'Teacher')])
+        self.assertEqual(len(db.cur.executed), 1)
+
+
+class RecordingWatchdog(object):
+    def __init__(self):
+        self.scheduled = []
+        self.cancelled = []
+
+    def schedule(self, timeout, fn):
+        entry = (timeout, fn)
+        self.scheduled.append(entry)
+        return entry
+
+    def cancel(self, entry):
+        self.cancelled.append(entry)
+
+
+class TestQueryTimeout(unittest.TestCase):
+    def testKilledQueryRaisesQueryTimeout(self):
+        gate = threading.Event()
+        db = stub_client(StubCursor(error=err.OperationalError(1317, 'Query execution was interrupted'), gate=gate))
+        killed = []
+
+        def kill_query(thread_id):
+            killed.append(thread_id)
+            gate.set()
+
+        db._kill_query = kill_query
+        with self.assertRaises(QueryTimeout) as cm:
+            db.query('SELECT SLEEP(10);', timeout=0.05)
+        self.assertEqual(cm.exception.args[0], 1317)
+        self.assertEqual(killed, [42])
+
+    def testInterruptedWithoutKillIsReraised(self):
+        error = err.OperationalError(1317, 'Query execution was interrupted')
+        db = stub_client(StubCursor(error=error))
+        db._kill_query = lambda thread_id: self.fail('Query should not be killed')
+        try:
+            db.update(table='jobs', value={'value': 'Teacher'}, where={'id': 5}, commit=False, timeout=5)
+        except err.OperationalError as e:
+            self.assertIs(e, error)
+            self.assertNotIsInstance(e, QueryTimeout)
+        else:
+            self.fail('OperationalError not raised')
+
+    def testServerTimeoutRaisesQueryTimeout(self):
+        for timeout in (None, 5):
+            db = stub_client(StubCursor(error=err.OperationalError(3024, 'Query execution was interrupted, maximum '
+                                                                         'statement execution time exceeded')))
+            db._kill_query = lambda thread_id: self.fail('Query should not be killed')
+            with self.assertRaises(QueryTimeout) as cm:
+                db.query('SELECT /*+ MAX_EXECUTION_TIME(1) */ SLEEP(10);', timeout=timeout)
+            self.assertEqual(cm.exception.args[0], 3024)
+
+    def testDeadlineCancelledOnSuccess(self):
+        watchdog = RecordingWatchdog()
+        original, dictmysql._watchdog = dictmysql._watchdog, watchdog
+        try:
+            db = stub_client(StubCursor(rows=[(1,)]), timeout=2)
+            self.assertEqual(db.query('SELECT 1;'), 1)
+        finally:
+            dictmysql._watchdog = original
+        self.assertEqual([t for t, fn in watchdog.scheduled], [2])
+        self.assertEqual(watchdog.cancelled, watchdog.scheduled)
+
+    def testSlowKillDoesNotDelayFinishedQuery(self):
+        gate = threading.Event()
+        db = stub_client(StubCursor(rows=[(1,)], gate=gate))
+        kill_started = threading.Event()
+        events = []
+
+        def kill_query(thread_id):
+            kill_started.set()
+            time.sleep(0.5)
+            events.append('killed')
+
+        db._kill_query = kill_query
+        finish = threading.Thread(target=lambda: kill_started.wait(5) and gate.set())
+        finish.start()
+        start = time.time()
+        self.assertEqual(db.query('SELECT SLEEP(1);', timeout=0.01), 1)
+        self.assertLess(time.time() - start, 0.4)
+        finish.join(5)
+
+        # the next statement waits for the late kill, so that it cannot be interrupted by it
+        db.cur = StubCursor(rows=[(1,)])
+        db.cur.execute = lambda sql, args=None: events.append('executed')
+        db.query('SELECT 1;')
+        self.assertEqual(events, ['killed', 'executed'])
+
+    def testSlowKillDoesNotDelayOtherDeadlines(self):
+        slow_gate, fast_gate = threading.Event(), threading.Event()
+        slow = stub_client(StubCursor(rows=[(1,)], gate=slow_gate))
+        fast = stub_client(StubCursor(error=err.OperationalError(1317, 'Query execution was interrupted'),
+                                      gate=fast_gate))
+        slow._kill_query = lambda thread_id: time.sleep(1) or slow_gate.set()
+        fast._kill_query = lambda thread_id: fast_gate.set()
+
+        t = threading.Thread(target=lambda: slow.query('SELECT SLEEP(10);', timeout=0.01))
+        t.start()
+        self.assertTrue(slow.cur.started.wait(5))
+        start = time.time()
+        with self.assertRaises(QueryTimeout):
+            fast.query('SELECT SLEEP(10);', timeout=0.05)
+        self.assertLess(time.time() - start, 0.5)
+        t.join(5)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Requires os.fork')
+    def testWatchdogRunsInForkedChild(self):
+        fired = threading.Event()
+        dictmysql._watchdog.schedule(0, fired.set)
+        self.assertTrue(fired.wait(5))
+
+        pid = os.fork()
+        if pid == 0:
+            fired = threading.Event()
+            dictmysql._watchdog.schedule(0, fired.set)
+            os._exit(0 if fired.wait(5) else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def testWatchdogSkipsCancelledDeadlines(self):
+        db = stub_client(StubCursor(rows=[(1,)]))
+        killed = []
+        db._kill_query = killed.append
+        db.query('SELECT 1;', timeout=0.01)
+        fired = threading.Event()
+        dictmysql._watchdog.schedule(0.02, fired.set)
+        self.assertTrue(fired.wait(5))
+        self.assertEqual(killed, [])
+
 
 if __name__ == '__main__':
     unittest.main()